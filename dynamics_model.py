@@ -1,9 +1,10 @@
 import sys
 import warnings
 import os
+import contextlib
+import inspect
 import torch
 import numpy as np
-from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
@@ -11,6 +12,147 @@ from collections import OrderedDict
 import hydra
 
 
+def autocast(enabled):
+    """
+    Mixed precision context for the training loops. Returns a CUDA autocast context when enabled and a context that
+    does nothing otherwise, so the loops still run on PyTorch versions without torch.cuda.amp (< 1.6)
+    """
+    if not enabled:
+        return contextlib.ExitStack()
+    # torch.autocast supersedes torch.cuda.amp.autocast, which is deprecated from PyTorch 2.4
+    if hasattr(torch, 'autocast'):
+        return torch.autocast('cuda')
+    return torch.cuda.amp.autocast()
+
+
+def grad_scaler():
+    """
+    Gradient scaler for mixed precision training, it keeps small FP16 gradients from underflowing. Uses
+    torch.amp.GradScaler when it exists, torch.cuda.amp.GradScaler is deprecated from PyTorch 2.4
+    """
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda')
+    return torch.cuda.amp.GradScaler()
+
+
+def use_amp(cfg, device):
+    """
+    Whether to train with mixed precision: cfg.model.optimizer.amp is set, training runs on CUDA and the installed
+    PyTorch has torch.cuda.amp
+    """
+    return bool(cfg.model.optimizer.get('amp', False)) and device.type == 'cuda' and hasattr(torch.cuda, 'amp')
+
+
+_compiled = {}
+
+
+def compile_fn(fn, device, enabled):
+    """
+    Compiles fn with torch.compile so TorchInductor fuses the activations into the matmuls and the per layer Python
+    dispatch goes away. Only used when enabled (cfg.model.optimizer.compile) for CUDA training on PyTorch 2.0+,
+    otherwise fn is returned unchanged. fn is wrapped once and reused, so it should be a module level function that
+    takes the model as an argument. Whether a new model reuses the compiled graph depends on the PyTorch version:
+    from 2.5 dynamo inlines nn.Modules and treats their parameters as graph inputs, so it does. Older versions guard
+    on the module passed in and recompile for every new model until dynamo's cache limit, then fn runs eagerly
+    """
+    if enabled and device.type == 'cuda' and hasattr(torch, 'compile'):
+        if fn not in _compiled:
+            _compiled[fn] = torch.compile(fn, mode='reduce-overhead')
+        return _compiled[fn]
+    return fn
+
+
+def adam(params, lr, device, fused):
+    """
+    Adam optimizer for the training loops. When fused (cfg.model.optimizer.fused) is set, on CUDA with PyTorch 2.0+ the
+    fused implementation is used, which updates every parameter in a single kernel launch
+    """
+    if fused and device.type == 'cuda' and 'fused' in inspect.signature(torch.optim.Adam).parameters:
+        return torch.optim.Adam(params, lr=lr, fused=True)
+    return torch.optim.Adam(params, lr=lr)
+
+
+def zero_grad(optimizer):
+    """
+    Clears the gradients of the optimizer's parameters by setting them to None, which skips the memset of zero_grad().
+    Same as optimizer.zero_grad(set_to_none=True), which needs PyTorch 1.7+
+    """
+    for group in optimizer.param_groups:
+        for param in group['params']:
+            param.grad = None
+
+
+def find_max_batch_size(forward_loss, inputs, targets, start=32, limit_frac=0.9, max_batch=4096, amp=False):
+    """
+    Finds the largest batch size for which one forward and backward pass of forward_loss fits in limit_frac of the GPU
+    memory. The batch size is doubled until a pass runs out of memory or goes over the limit, then binary searched
+    between the last size that fit and the first that did not. The passes run eagerly, so the memory of a compiled
+    loss with CUDA graphs is not measured exactly.
+    Note that this picks the batch size for throughput only. A larger batch means fewer optimizer steps per epoch, so
+    with batch: auto the same epochs and lr optimize differently than with the configured batch size. The small nets
+    here fit the whole dataset in one batch, so without the max_batch cap every epoch would be a single step
+    :param forward_loss: function of a batch of inputs and targets returning the loss
+    :param inputs: training inputs on the GPU, batches are taken along dim -2
+    :param targets: training targets on the GPU, batches are taken along dim -2
+    :param start: batch size to start from, also returned when training on the CPU
+    :param limit_frac: fraction of the GPU memory a pass may use
+    :param max_batch: largest batch size returned (cfg.model.optimizer.max_batch)
+    :param amp: run the passes under autocast, as the training loop does with mixed precision
+    :return: the batch size, at most max_batch and the size of the dataset
+    """
+    device = inputs.device
+    n = min(inputs.shape[-2], max_batch)
+    if device.type != 'cuda':
+        return min(start, n)
+    limit = limit_frac * torch.cuda.get_device_properties(device).total_memory
+    # reset_max_memory_allocated was replaced by reset_peak_memory_stats in PyTorch 1.4
+    reset_peak = getattr(torch.cuda, 'reset_peak_memory_stats', None) or torch.cuda.reset_max_memory_allocated
+
+    def fits(bs):
+        torch.cuda.empty_cache()
+        reset_peak(device)
+        try:
+            with autocast(amp):
+                loss = forward_loss(inputs.narrow(-2, 0, bs), targets.narrow(-2, 0, bs)).sum()
+            loss.backward()
+        except RuntimeError as e:
+            # torch.cuda.OutOfMemoryError is a RuntimeError, older versions raise a plain one
+            if 'out of memory' not in str(e):
+                raise
+            return False
+        return torch.cuda.max_memory_allocated(device) < limit
+
+    low, high = 0, min(start, n)
+    while fits(high):
+        low = high
+        if high == n:
+            return n
+        high = min(2 * high, n)
+    while high - low > 1:
+        mid = (low + high) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid
+    torch.cuda.empty_cache()
+    return max(low, 1)
+
+
+def net_loss(net, inputs, targets):
+    """
+    Loss of a Net on a batch of inputs and targets
+    """
+    return net.loss_fn(net.forward(inputs), targets)
+
+
+def ensemble_loss(model, inputs, targets):
+    """
+    Losses of every net of a DynamicsModel, net i on the batch inputs[i] and targets[i]
+    """
+    outputs = model.ensemble_forward(inputs)
+    return torch.stack([model.loss_fn(o, t) for o, t in zip(outputs, targets)])
+
+
 class Net(nn.Module):
     """
     General Neural Network
@@ -49,8 +191,8 @@ class Net(nn.Module):
         Runs a forward pass of x through this network
         """
         if type(x) == np.ndarray:
-            x = torch.from_numpy(x)
-        x = self.features(x.float())
+            x = torch.as_tensor(x, dtype=torch.float32)
+        x = self.features(x)
         return x
 
     def testPreprocess(self, input, cfg):
@@ -112,7 +254,7 @@ class Net(nn.Module):
             normParams = self.paramScaler.transform(inputParams)
             normOutput = self.outputScaler.transform(output)
             normInput = np.hstack((normStates, normIndex, normParams))
-            return list(zip(normInput, normOutput))
+            return normInput, normOutput
         else:
             self.stateScaler = hydra.utils.instantiate(cfg.model.preprocess.state)
             self.actionScaler = hydra.utils.instantiate(cfg.model.preprocess.action)
@@ -134,16 +276,32 @@ class Net(nn.Module):
             else:
                 normInput = normStates
 
-            return list(zip(normInput, normOutput))
+            return normInput, normOutput
+
+    def tensorize(self, dataset, cfg):
+        """
+        Normalizes dataset with preprocess and converts it to float tensors once for the whole dataset, randomly
+        subsampled to cfg.model.optimizer.max_size if that is set
+        Returns:
+            normInput, normOutput: tensors of the normalized inputs and outputs
+        """
+        normInput, normOutput = self.preprocess(dataset, cfg)
+        normInput = torch.as_tensor(normInput, dtype=torch.float32)
+        normOutput = torch.as_tensor(normOutput, dtype=torch.float32)
+
+        if 0 < cfg.model.optimizer.max_size < len(normInput):
+            sample = torch.randperm(len(normInput))[:cfg.model.optimizer.max_size]
+            normInput, normOutput = normInput[sample], normOutput[sample]
+        return normInput, normOutput
 
     def optimize(self, dataset, cfg):
         """
-        Uses dataset to train this net according to the parameters in cfg
+        Uses dataset to train this net according to the parameters in cfg. The net is left on the training device
         Returns:
             train_errors: a list of average errors for each epoch on the training data
             test_errors: a list of average errors for each epoch on the test data
         """
-        from torch.utils.data import DataLoader
+        from torch.utils.data import DataLoader, TensorDataset, BatchSampler, RandomSampler, SequentialSampler
 
         # Extract parameters from cfg
         lr = cfg.model.optimizer.lr
@@ -151,21 +309,44 @@ class Net(nn.Module):
         split = cfg.model.optimizer.split
         epochs = cfg.model.optimizer.epochs
 
-        # Set up the optimizer and scheduler
-        # TODO: the scheduler is currently unused. Should it be doing something it isn't or removed?
-        optimizer = torch.optim.Adam(self.features.parameters(), lr=lr)
-        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=6, gamma=0.7)
-
         # data preprocessing for normalization
-        dataset = self.preprocess(dataset, cfg)
-
-        if 0 < cfg.model.optimizer.max_size < len(dataset):
-            import random
-            dataset = random.sample(dataset, cfg.model.optimizer.max_size)
-
-        # Puts it in PyTorch dataset form and then converts to DataLoader
-        trainLoader = DataLoader(dataset[:int(split * len(dataset))], batch_size=bs, shuffle=True)
-        testLoader = DataLoader(dataset[int(split * len(dataset)):], batch_size=bs, shuffle=True)
+        normInput, normOutput = self.tensorize(dataset, cfg)
+
+        # Train on the GPU when there is one. The dataset is moved there once, so batches are gathered on the device
+        # and there are no per batch host to device copies
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.to(device)
+        normInput, normOutput = normInput.to(device), normOutput.to(device)
+
+        # Set up the optimizer
+        optimizer = adam(self.features.parameters(), lr, device, cfg.model.optimizer.get('fused', False))
+
+        # Mixed precision on the GPU when enabled in the config. The weights and the optimizer stay in FP32
+        amp = use_amp(cfg, device)
+        if amp:
+            scaler = grad_scaler()
+
+        n_train = int(split * len(normInput))
+        if bs == 'auto':
+            bs = find_max_batch_size(lambda inputs, targets: net_loss(self, inputs, targets),
+                                     normInput[:n_train], normOutput[:n_train],
+                                     max_batch=cfg.model.optimizer.get('max_batch', 4096), amp=amp)
+            print("    Batch size %d" % bs)
+
+        # only the training step is compiled, the test batches run eagerly so the partial last batch doesn't
+        # trigger another compile
+        train_loss = compile_fn(net_loss, device, cfg.model.optimizer.get('compile', False))
+
+        # Puts it in PyTorch dataset form and then converts to DataLoader. The sampler yields a whole batch of
+        # indices at a time, so each batch is one indexing op on the tensors instead of collating single samples.
+        # Dropping the last partial batch keeps every training batch the same shape
+        trainData = TensorDataset(normInput[:n_train], normOutput[:n_train])
+        testData = TensorDataset(normInput[n_train:], normOutput[n_train:])
+        trainLoader = DataLoader(trainData, batch_size=None,
+                                 sampler=BatchSampler(RandomSampler(trainData), batch_size=bs,
+                                                      drop_last=len(trainData) >= bs))
+        testLoader = DataLoader(testData, batch_size=None,
+                                sampler=BatchSampler(SequentialSampler(testData), batch_size=bs, drop_last=False))
 
         # Optimization loop
         train_errors = []
@@ -173,28 +354,35 @@ class Net(nn.Module):
         for epoch in range(epochs):
             print("    Epoch %d" % (epoch + 1))
 
-            train_error = 0
-            test_error = 0
+            # errors are summed on the device and only read back once per epoch to avoid a sync every batch
+            train_error = torch.zeros((), device=device)
+            test_error = torch.zeros((), device=device)
 
             # Iterate through dataset and take gradient descent steps
             for i, (inputs, targets) in enumerate(trainLoader):
-                optimizer.zero_grad()
-                outputs = self.forward(inputs)
-                loss = self.loss_fn(outputs.float(), targets.float())
-                train_error += loss.item() / (len(trainLoader) * bs)
-
-                loss.backward()
-                optimizer.step()  # Does the update
+                zero_grad(optimizer)
+                with autocast(amp):
+                    loss = train_loss(self, inputs, targets)
+                train_error += loss.detach()
+
+                if amp:
+                    scaler.scale(loss).backward()
+                    scaler.step(optimizer)  # Does the update, skipped if the gradients overflowed
+                    scaler.update()
+                else:
+                    loss.backward()
+                    optimizer.step()  # Does the update
 
             # Iterate through dataset to calculate test set accuracy
-            test_error = torch.zeros(1)
-            for i, (inputs, targets) in enumerate(testLoader):
-                outputs = self.forward(inputs)
-                loss = self.loss_fn(outputs.float(), targets.float())
-                test_error += loss.item() / (len(testLoader) * bs)
+            with torch.no_grad():
+                for i, (inputs, targets) in enumerate(testLoader):
+                    with autocast(amp):
+                        loss = net_loss(self, inputs, targets)
+                    test_error += loss
 
-            train_errors.append(train_error)
-            test_errors.append(test_error.item())
+            train_errors.append((train_error / (len(trainLoader) * bs)).item())
+            # an empty test split (split=1) reports 0 rather than 0/0
+            test_errors.append((test_error / (max(len(testLoader), 1) * bs)).item())
 
         return train_errors, test_errors
 
@@ -250,20 +438,132 @@ class DynamicsModel(object):
         TODO: particle sampling approach for probabilistic model
         """
         if type(x) == np.ndarray:
-            x = torch.from_numpy(x)
-        prediction = torch.zeros((x.shape[0], len(self.state_indices)))
-        for n in self.nets:
-            scaledInput = n.testPreprocess(x, self.cfg)
-            if self.prob:
-                prediction += n.testPostprocess(n.forward(scaledInput)[:, :len(self.state_indices)]) / len(self.nets)
-            else:
-                prediction += n.testPostprocess(n.forward(scaledInput)) / len(self.nets)
+            x = torch.as_tensor(x, dtype=torch.float32)
+        # each net has its own scalers, so the inputs are normalized per net and stacked along the ensemble dim
+        scaledInput = torch.as_tensor(np.stack([n.testPreprocess(x, self.cfg) for n in self.nets]), dtype=torch.float32)
+        with torch.no_grad():
+            outputs = self.ensemble_forward(scaledInput)
+        # probabilistic nets also output the log variance, only the mean is used
+        prediction = torch.stack([n.testPostprocess(output[:, :len(self.state_indices)])
+                                  for n, output in zip(self.nets, outputs)]).mean(dim=0)
         if not self.delta:
             return prediction[:, :len(self.state_indices)]
         else:
             # This hardcode is the state size changing. X also includes the action / index
             return x[:, :len(self.state_indices)] + prediction
 
+    def ensemble_forward(self, x):
+        """
+        Runs a forward pass through every net of the ensemble at once. Each linear layer is computed for all nets
+        with one batched matmul over their stacked weights instead of one forward call per net
+        :param x: tensor of shape (E, batch, n_in), where x[i] is the input to net i
+        :return: tensor of shape (E, batch, n_out)
+        """
+        for layers in zip(*[n.features for n in self.nets]):
+            if isinstance(layers[0], nn.Linear):
+                weight = torch.stack([l.weight for l in layers])
+                bias = torch.stack([l.bias for l in layers]).unsqueeze(1)
+                x = torch.baddbmm(bias, x, weight.transpose(1, 2))
+            else:
+                x = layers[0](x)
+        return x
+
+    def optimize_ensemble(self, dataset, folds, cfg):
+        """
+        Trains every net of the ensemble at the same time, net i on the rows folds[i] of dataset. Each step runs all
+        nets through ensemble_forward, so the ensemble takes one batched step instead of running E separate training
+        loops. The folds have to be the same size after preprocessing. The nets are left on the training device
+        Returns:
+            train_errors: for each net, a list of average errors for each epoch on its training data
+            test_errors: for each net, a list of average errors for each epoch on its test data
+        """
+        # Extract parameters from cfg
+        lr = cfg.model.optimizer.lr
+        bs = cfg.model.optimizer.batch
+        split = cfg.model.optimizer.split
+        epochs = cfg.model.optimizer.epochs
+
+        # data preprocessing for normalization, each net fits its own scalers on its fold. The folds are sliced out of
+        # dataset one at a time and written into a single (E, N, width) tensor, so at most one fold copy exists at once
+        normInput, normOutput = None, None
+        for i, (n, train_idx) in enumerate(zip(self.nets, folds)):
+            inputs, outputs = n.tensorize((dataset[0][train_idx], dataset[1][train_idx]), cfg)
+            if normInput is None:
+                normInput = inputs.new_empty((self.E,) + inputs.shape)
+                normOutput = outputs.new_empty((self.E,) + outputs.shape)
+            normInput[i], normOutput[i] = inputs, outputs
+
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        for n in self.nets:
+            n.to(device)
+        normInput, normOutput = normInput.to(device), normOutput.to(device)
+
+        # Adam updates each parameter on its own, so one optimizer over all nets matches one optimizer per net
+        optimizer = adam([p for n in self.nets for p in n.features.parameters()], lr, device,
+                         cfg.model.optimizer.get('fused', False))
+
+        amp = use_amp(cfg, device)
+        if amp:
+            scaler = grad_scaler()
+
+        n_train = int(split * normInput.shape[1])
+        if bs == 'auto':
+            bs = find_max_batch_size(lambda inputs, targets: ensemble_loss(self, inputs, targets),
+                                     normInput[:, :n_train], normOutput[:, :n_train],
+                                     max_batch=cfg.model.optimizer.get('max_batch', 4096), amp=amp)
+            print("    Batch size %d" % bs)
+
+        # only the training step is compiled, the test batches run eagerly
+        train_loss = compile_fn(ensemble_loss, device, cfg.model.optimizer.get('compile', False))
+
+        # the last partial batch is dropped so every training batch has the same shape
+        n_train_batches = max(n_train // bs, 1)
+        n_test_batches = (normInput.shape[1] - n_train + bs - 1) // bs
+
+        # Optimization loop
+        train_errors = []
+        test_errors = []
+        for epoch in range(epochs):
+            print("    Epoch %d" % (epoch + 1))
+
+            # errors of every net are summed on the device and only read back once per epoch
+            train_error = torch.zeros(self.E, device=device)
+            test_error = torch.zeros(self.E, device=device)
+
+            # Iterate through dataset and take gradient descent steps, the nets share the shuffled batch indices
+            for idx in torch.randperm(n_train, device=device).split(bs)[:n_train_batches]:
+                zero_grad(optimizer)
+                with autocast(amp):
+                    losses = train_loss(self, normInput[:, idx], normOutput[:, idx])
+                train_error += losses.detach()
+
+                # the nets share no parameters, so the gradient of the sum is each net's gradient of its own loss
+                loss = losses.sum()
+                if amp:
+                    scaler.scale(loss).backward()
+                    scaler.step(optimizer)  # Does the update, skipped if the gradients overflowed
+                    scaler.update()
+                else:
+                    loss.backward()
+                    optimizer.step()  # Does the update
+
+            # Iterate through dataset to calculate test set accuracy
+            # an empty tensor still splits into one empty chunk, so the chunks are cut to the number of test batches
+            testInput = normInput[:, n_train:].split(bs, dim=1)[:n_test_batches]
+            testOutput = normOutput[:, n_train:].split(bs, dim=1)[:n_test_batches]
+            with torch.no_grad():
+                for inputs, targets in zip(testInput, testOutput):
+                    with autocast(amp):
+                        losses = ensemble_loss(self, inputs, targets)
+                    test_error += losses
+
+            train_errors.append((train_error / (n_train_batches * bs)).tolist())
+            # an empty test split (split=1) reports 0 rather than 0/0
+            test_errors.append((test_error / (max(n_test_batches, 1) * bs)).tolist())
+
+        # regroup from per epoch to per net
+        return [list(e) for e in zip(*train_errors)], [list(e) for e in zip(*test_errors)]
+
     def train(self, dataset, cfg):
         acctest_l = []
         acctrain_l = []
@@ -280,20 +580,24 @@ class DynamicsModel(object):
             # setup cross validation-ish datasets for training ensemble
             kf = KFold(n_splits=self.E)
             kf.get_n_splits(dataset)
-
-            # iterate through the validation sets
-            for (i, n), (train_idx, test_idx) in zip(enumerate(self.nets), kf.split(dataset[0])):
-                print("  Model %d" % (i + 1))
-                # only train on training data to ensure diversity
-                sub_data = (dataset[0][train_idx], dataset[1][train_idx])
-                train_e, test_e = n.optimize(sub_data, cfg)
-                acctrain_l.append(train_e)
-                acctest_l.append(test_e)
+            folds = [train_idx for train_idx, test_idx in kf.split(dataset[0])]
+            # the folds differ by at most one sample when the dataset doesn't split evenly. They are trimmed to the
+            # same size so the whole ensemble can be trained in one batched loop, which drops the last training sample
+            # from the larger folds
+            min_len = min(len(f) for f in folds)
+            folds = [f[:min_len] for f in folds]
+
+            # only train on training data to ensure diversity
+            acctrain_l, acctest_l = self.optimize_ensemble(dataset, folds, cfg)
         else:
             train_e, test_e = self.nets[0].optimize(dataset, cfg)
             acctrain_l.append(train_e)
             acctest_l.append(test_e)
 
+        # predict() and the scalers work on the CPU
+        for n in self.nets:
+            n.cpu()
+
         self.acctrain, self.acctest = acctrain_l, acctest_l
 
         return acctrain_l, acctest_l
@@ -307,33 +611,23 @@ class ProbLoss(nn.Module):
     def __init__(self, size):
         super(ProbLoss, self).__init__()
         self.size = size
-        self.max_logvar = torch.nn.Parameter(
-            torch.tensor(1 * np.ones([1, size]), dtype=torch.float, requires_grad=True))
-        self.min_logvar = torch.nn.Parameter(
-            torch.tensor(-1 * np.ones([1, size]), dtype=torch.float, requires_grad=True))
-
-    def softplus_raw(self, input):
-        # Performs the elementwise softplus on the input
-        # softplus(x) = 1/B * log(1+exp(B*x))
-        B = torch.tensor(1, dtype=torch.float)
-        return (torch.log(1 + torch.exp(input.mul_(B)))).div_(B)
-
-        # TODO: This function has been observed outputting negative values. needs fix
+        self.max_logvar = torch.nn.Parameter(torch.ones(1, size))
+        self.min_logvar = torch.nn.Parameter(-torch.ones(1, size))
 
     def forward(self, inputs, targets):
         # size = targets.size()[1]
         mean = inputs[:, :self.size]
         logvar = inputs[:, self.size:]
 
-        # Caps max and min log to avoid NaNs
-        logvar = self.max_logvar - self.softplus_raw(self.max_logvar - logvar)
-        logvar = self.min_logvar + self.softplus_raw(logvar - self.min_logvar)
+        # Caps max and min log to avoid NaNs, F.softplus is stable for large inputs where log(1+exp(x)) overflows
+        logvar = self.max_logvar - F.softplus(self.max_logvar - logvar)
+        logvar = self.min_logvar + F.softplus(logvar - self.min_logvar)
 
         var = torch.exp(logvar)
 
         diff = mean - targets
         mid = torch.div(diff, var)
         lg = torch.sum(torch.log(var))
-        out = torch.trace(torch.mm(diff, mid.t())) + lg
+        out = torch.sum(diff * mid) + lg
         # same as torch.sum(((mean - targets) ** 2) / var) + lg
         return out
@@ -5,7 +5,6 @@ from timeit import default_timer as timer
 import matplotlib.pyplot as plt
 
 import torch
-from torch.autograd import Variable
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.backends.cudnn as cudnn
@@ -20,6 +19,8 @@ import logging
 
 import multiprocessing as mp
 
+from dynamics_model import autocast, grad_scaler, use_amp
+
 log = logging.getLogger(__name__)
 
 
@@ -141,7 +142,8 @@ class Net(nn.Module):
             pass
         else:
             scaledInput = self.testPreprocess(x)
-            output = self.forward(Variable(torch.from_numpy(np.matrix(scaledInput)).float())).data.cpu().numpy()
+            scaledInput = torch.as_tensor(np.atleast_2d(scaledInput), dtype=torch.float32)
+            output = self.forward(scaledInput).detach().cpu().numpy()
             return self.testPostprocess(output)
 
 
@@ -153,34 +155,24 @@ class ProbLoss(nn.Module):
     def __init__(self, size):
         super(ProbLoss, self).__init__()
         self.size = size
-        self.max_logvar = torch.nn.Parameter(
-            torch.tensor(1 * np.ones([1, size]), dtype=torch.float, requires_grad=True))
-        self.min_logvar = torch.nn.Parameter(
-            torch.tensor(-1 * np.ones([1, size]), dtype=torch.float, requires_grad=True))
-
-    def softplus_raw(self, input):
-        # Performs the elementwise softplus on the input
-        # softplus(x) = 1/B * log(1+exp(B*x))
-        B = torch.tensor(1, dtype=torch.float)
-        return (torch.log(1 + torch.exp(input.mul_(B)))).div_(B)
-
-        # TODO: This function has been observed outputting negative values. needs fix
+        self.max_logvar = torch.nn.Parameter(torch.ones(1, size))
+        self.min_logvar = torch.nn.Parameter(-torch.ones(1, size))
 
     def forward(self, inputs, targets):
         # size = targets.size()[1]
         mean = inputs[:, :self.size]
         logvar = inputs[:, self.size:]
 
-        # Caps max and min log to avoid NaNs
-        logvar = self.max_logvar - self.softplus_raw(self.max_logvar - logvar)
-        logvar = self.min_logvar + self.softplus_raw(logvar - self.min_logvar)
+        # Caps max and min log to avoid NaNs, F.softplus is stable for large inputs where log(1+exp(x)) overflows
+        logvar = self.max_logvar - F.softplus(self.max_logvar - logvar)
+        logvar = self.min_logvar + F.softplus(logvar - self.min_logvar)
 
         var = torch.exp(logvar)
 
         diff = mean - targets
         mid = diff / var
         lg = torch.sum(torch.log(var))
-        out = torch.trace(torch.mm(diff, mid.t())) + lg
+        out = torch.sum(diff * mid) + lg
         return out
 
 
@@ -301,7 +293,7 @@ def train_network(dataset, model, cfg, parameters=DotMap()):
     """
     import torch.optim as optim
     from torch.utils.data.dataset import Dataset
-    from torch.utils.data import DataLoader
+    from torch.utils.data import DataLoader, TensorDataset
 
     # This bit basically adds variables to the dotmap with default values
     p = DotMap()
@@ -331,9 +323,14 @@ def train_network(dataset, model, cfg, parameters=DotMap()):
     # Lets cudnn autotuner find optimal algorithm for hardware
     cudnn.benchmark = True
 
-    if p.useGPU:
-        model.cuda()
-        p.criterion.cuda()
+    device = torch.device('cuda' if p.useGPU else 'cpu')
+    model.to(device)
+    p.criterion.to(device)
+
+    # Mixed precision on the GPU when enabled in the config, the weights and the optimizer stay in FP32
+    amp = use_amp(cfg, device)
+    if amp:
+        scaler = grad_scaler()
 
     # Wrapper representing map-style PyTorch dataset
     class PytorchDataset(Dataset):
@@ -363,12 +360,15 @@ def train_network(dataset, model, cfg, parameters=DotMap()):
     # dataset = PytorchDataset(dataset=dataset)  # Using PyTorch
     # dataset = np.hstack((dataset[0], dataset[1]))
     scaled_input, scaled_output = model.preprocess(dataset, cfg)
-    dataset = list(zip(scaled_input, scaled_output))
+    scaled_input = torch.as_tensor(scaled_input, dtype=torch.float32)
+    scaled_output = torch.as_tensor(scaled_output, dtype=torch.float32)
     split = cfg.model.optimizer.split
-    trainLoader = DataLoader(dataset[:int(split * len(dataset))], batch_size=p.opt.batch_size, shuffle=True)
-    testLoader = DataLoader(dataset[int(split * len(dataset)):], batch_size=p.opt.batch_size, shuffle=True)
+    n_train = int(split * len(scaled_input))
+    trainLoader = DataLoader(TensorDataset(scaled_input[:n_train], scaled_output[:n_train]),
+                             batch_size=p.opt.batch_size, shuffle=True, pin_memory=p.useGPU)
+    testLoader = DataLoader(TensorDataset(scaled_input[n_train:], scaled_output[n_train:]),
+                            batch_size=p.opt.batch_size, shuffle=False, pin_memory=p.useGPU)
     # loader = DataLoader(dataset, batch_size=p.opt.batch_size, shuffle=True)  ##shuffle=True #False
-    # pin_memory=True
     # drop_last=False
 
     startTime = timer()
@@ -378,46 +378,53 @@ def train_network(dataset, model, cfg, parameters=DotMap()):
     # print("Training for %d epochs" % p.opt.n_epochs)
 
     for epoch in range(p.opt.n_epochs):
-        epoch_error = 0
+        epoch_error = torch.zeros((), device=device)
+        batch_errors = []
         log.info("Epoch %d" % (epoch))
         for i, (inputs, targets) in enumerate(trainLoader):
             if i % 500 == 0 and i > 0:
                 print("    Batch %d" % i)
-            # Load data
-            # Variable is a wrapper for Tensors with autograd
-            # inputs, targets = data
-            if p.useGPU:
-                inputs = Variable(inputs.cuda())
-                targets = Variable(targets.cuda())
-            else:
-                inputs = Variable(inputs)
-                targets = Variable(targets)
+            # Load data, the copy overlaps with compute when the batch is in pinned memory
+            inputs = inputs.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
 
             optimizer.zero_grad()
-            outputs = model.forward(inputs.float())
-            loss = p.criterion(outputs, targets)
+            with autocast(amp):
+                outputs = model.forward(inputs)
+                loss = p.criterion(outputs, targets)
             # print(loss)
 
-            e = loss.item()
-            logs.training_error.append(e)
-            epoch_error += e / (len(trainLoader) * p.opt.batch_size)
+            # per batch errors are only kept at higher verbosity, and read back once per epoch rather than every batch
+            if p.verbosity > 1:
+                batch_errors.append(loss.detach())
+            epoch_error += loss.detach()
 
-            loss.backward()
-            optimizer.step()  # Does the update
+            if amp:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)  # Does the update, skipped if the gradients overflowed
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()  # Does the update
             logs.time.append(timer() - logs.time[-1])
 
             if p.evaluator is not None and i % 25 == 0:
                 logs.evaluations.append(p.evaluator(model))
 
-        test_error = torch.zeros(1)
+        test_error = torch.zeros((), device=device)
         for i, (inputs, targets) in enumerate(testLoader):
-            outputs = model.forward(inputs.float())
-            loss = p.criterion(outputs, targets)
-
-            test_error += loss.item() / (len(testLoader) * p.opt.batch_size)
-        test_error = test_error
-
-        logs.training_error_epoch.append(epoch_error)
+            inputs = inputs.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)
+            with autocast(amp):
+                outputs = model.forward(inputs)
+                loss = p.criterion(outputs, targets)
+
+            test_error += loss.detach()
+        test_error = (test_error / (max(len(testLoader), 1) * p.opt.batch_size)).item()
+
+        if batch_errors:
+            logs.training_error.extend(torch.stack(batch_errors).tolist())
+        logs.training_error_epoch.append((epoch_error / (len(trainLoader) * p.opt.batch_size)).item())
 
     endTime = timer()
     log.info('Optimization completed in %f[s]' % (endTime - startTime))
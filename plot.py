@@ -1,5 +1,6 @@
 import os
 import sys
+import fnmatch
 import glob
 
 import hydra
@@ -96,15 +97,25 @@ def find_latest_checkpoint(cfg):
     checkpoint_paths = os.path.join(os.getcwd(),
                                     cfg.checkpoint_file.replace("{}", "*"))
 
-    # use glob to find files (returned a list)
-    files = glob.glob(checkpoint_paths)
+    directory, pattern = os.path.split(checkpoint_paths)
+    if glob.has_magic(directory):
+        # a wildcard in the directory part needs a full glob
+        files = [(os.path.getmtime(f), f) for f in glob.glob(checkpoint_paths)]
+    elif not os.path.isdir(directory):
+        return None
+    else:
+        # list the directory in a single scan and stat every match once, building (mtime, path) pairs so max doesn't
+        # stat again. Like glob, hidden files only match a pattern that starts with a dot
+        files = [(entry.stat().st_mtime, entry.path) for entry in os.scandir(directory)
+                 if (pattern.startswith('.') or not entry.name.startswith('.'))
+                 and fnmatch.fnmatch(entry.name, pattern)]
 
     # If we cannot find one (empty file list), then do nothing and return
     if not files:
         return None
 
-    # find the one with maximum last modified time (getmtime). Don't sort
-    last_modified_file = max(files, key=os.path.getmtime)
+    # find the one with maximum last modified time. Don't sort
+    last_modified_file = max(files)[1]
 
     return last_modified_file
 
@@ -158,6 +169,8 @@ def plot_reacher(states, actions):
 
 
 def generate_errorbar_traces(ys, xs=None, percentiles='66+95', color=None, name=None):
+    # generated x values are identical by construction, so they only need checking when passed in
+    check_xs = xs is not None
     if xs is None:
         xs = [list(range(len(y))) for y in ys]
 
@@ -169,8 +182,10 @@ def generate_errorbar_traces(ys, xs=None, percentiles='66+95', color=None, name=
     assert all([(len(y) == len(ys[0])) for y in ys]), \
         'Y should be the same size for all traces'
 
-    assert all([(x == xs[0]) for x in xs]), \
-        'X should be the same for all traces'
+    if check_xs:
+        xs_arr = np.asarray(xs)
+        assert (xs_arr == xs_arr[0]).all(), \
+            'X should be the same for all traces'
 
     y = np.array(ys)
 
@@ -199,13 +214,15 @@ def generate_errorbar_traces(ys, xs=None, percentiles='66+95', color=None, name=
     interval = np.nan_to_num(interval)  # Fix stupid case of norm.interval(0) returning nan
     '''
 
+    # x values out and back along the band, shared by every percentile
+    x_band = xs[0] + xs[0][::-1]
     for i, p_str in enumerate(percentiles.split("+")):
         p = int(p_str)
         high = out[1][2 * i, :]
         low = out[1][2 * i + 1, :]
 
         err_traces.append(dict(
-            x=xs[0] + xs[0][::-1], type='scatter',
+            x=x_band, type='scatter',
             y=(high).tolist() + (low).tolist()[::-1],
             fill='toself',
             fillcolor=(color[:-1] + str(f", {intensity})")).replace('rgb', 'rgba')
@@ -240,18 +257,11 @@ def plot_states(ground_truth, predictions, idx_plot=None, plot_avg=True, save_lo
         ax.spines['right'].set_visible(False)
         ax.spines['top'].set_visible(False)
 
-        gt = np.zeros(ground_truth[:, 0:1].shape)
-        for i in idx_plot:
-            gt = np.hstack((gt, ground_truth[:, i:i + 1]))
-        gt_avg = np.average(gt[:, 1:], axis=1)
+        gt_avg = np.average(ground_truth[:, idx_plot], axis=1)
         plt.plot(gt_avg, c='k', label='Groundtruth')
 
         for key in predictions:
-            pred = predictions[key]
-            p = np.zeros(pred[:, 0:1].shape)
-            for i in idx_plot:
-                p = np.hstack((p, pred[:, i:i + 1]))
-            p_avg = np.average(p[:, 1:], axis=1)
+            p_avg = np.average(predictions[key][:, idx_plot], axis=1)
             chopped = [(x if abs(x) < 3 else float("nan")) for x in p_avg]
             plt.plot(chopped, c=color_dict[key], label=label_dict[key], markersize=10, marker=marker_dict[key],
                      markevery=50)
@@ -264,32 +274,38 @@ def plot_states(ground_truth, predictions, idx_plot=None, plot_avg=True, save_lo
         else:
             plt.close()
 
-    for i in idx_plot:
-        fig, ax = plt.subplots()
+    # no states to plot, subplots can't make a figure with zero rows
+    if len(idx_plot) == 0:
+        return
+
+    # one figure with a row per state instead of a figure per state
+    fig, axes = plt.subplots(len(idx_plot), 1, figsize=(8, 2 * len(idx_plot)), squeeze=False)
+    for ax, i in zip(axes[:, 0], idx_plot):
         gt = ground_truth[:, i]
-        plt.title("Predictions on one dimension")
-        plt.xlabel("Timestep")
-        plt.ylabel("State Value")
+        ax.set_title("Predictions on dimension %d" % i)
+        ax.set_ylabel("State Value")
         ax.spines['right'].set_visible(False)
         ax.spines['top'].set_visible(False)
 
-        plt.plot(gt, c='k', label='Groundtruth')
+        ax.plot(gt, c='k', label='Groundtruth')
         for key in predictions:
             # print(key)
             pred = predictions[key][:, i]
             # chopped = np.maximum(np.minimum(pred, 3), -3)  # to keep it from messing up graphs when it diverges
             chopped = [(x if abs(x) < 3 else float("nan")) for x in pred]
-            plt.plot(chopped, c=color_dict[key], label=label_dict[key], markersize=10, marker=marker_dict[key],
-                     markevery=50)
+            ax.plot(chopped, c=color_dict[key], label=label_dict[key], markersize=10, marker=marker_dict[key],
+                    markevery=50)
 
-        plt.legend()
+    axes[-1, 0].set_xlabel("Timestep")
+    axes[0, 0].legend()
+    fig.tight_layout()
 
-        if save_loc:
-            plt.savefig(save_loc + "-state%d.pdf" % i)
-        if show:
-            plt.show()
-        else:
-            plt.close()
+    if save_loc:
+        plt.savefig(save_loc + "-states.pdf")
+    if show:
+        plt.show()
+    else:
+        plt.close()
 
 
 def plot_loss(train_logs, test_logs, cfg, save_loc=None, show=False, title=None):